@@ -1,17 +1,233 @@
 #!/usr/bin/env python3
 import os
-import io
+import re
+import errno
 import json
+import mmap
+import time
 import shutil
 import hashlib
 import zipfile
 import tempfile
 import argparse
+import threading
+import contextlib
 import subprocess
+import http.client
+import urllib.error
+import urllib.parse
 import urllib.request
 from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, CancelledError, as_completed
 import string
 
+try:
+    # optional, parses the large Visual Studio manifest several times faster
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# .cab files referenced by the SDK msi files are named by a 32 digit hex hash
+CAB_RE = re.compile(rb"[0-9a-f]{32}\.cab", re.IGNORECASE)
+
+ARCHES = ("x86", "x64", "arm", "arm64")
+
+# MSVC and Windows SDK components, as lowercased package ids
+VC_PREFIX = "microsoft.visualstudio.component.vc."
+VC_SUFFIX = ".x86.x64"
+SDK_PREFIXES = (
+    "microsoft.visualstudio.component.windows10sdk.",
+    "microsoft.visualstudio.component.windows11sdk.",
+)
+
+
+class MappedFile(mmap.mmap):
+    """Read-only memory map of a whole file that ZipFile can read from,
+    mmap only reports itself as seekable since Python 3.13."""
+
+    def seekable(self):
+        return True
+
+
+class ConnectionPool:
+    """Keeps HTTP(S) connections alive so that downloads from the same host
+    skip the TCP and TLS handshakes. Safe to share between threads, at most
+    maxsize requests are in flight at once, further ones wait for a slot.
+
+    Connection errors and transient server errors are retried with an
+    exponential backoff, honoring Retry-After."""
+
+    REDIRECT_STATUS = (301, 302, 303, 307, 308)
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, maxsize=16, retries=5, backoff_factor=0.5, timeout=60):
+        self.maxsize = maxsize
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(maxsize)
+
+    def connect(self, scheme, host):
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=self.timeout)
+        return http.client.HTTPConnection(host, timeout=self.timeout)
+
+    def acquire(self, scheme, host):
+        with self.lock:
+            conns = self.idle.get((scheme, host))
+            return conns.pop() if conns else None
+
+    def release(self, scheme, host, conn):
+        with self.lock:
+            conns = self.idle.setdefault((scheme, host), [])
+            if len(conns) < self.maxsize:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def finish(self, scheme, host, conn, res):
+        # the connection can only be reused once the body was consumed
+        if res.isclosed():
+            self.release(scheme, host, conn)
+        else:
+            conn.close()
+
+    def request(self, scheme, host, path, headers):
+        conn = self.acquire(scheme, host)
+        if conn is not None:
+            try:
+                conn.request("GET", path, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                # the server may have dropped the idle connection
+                conn.close()
+        conn = self.connect(scheme, host)
+        try:
+            conn.request("GET", path, headers=headers)
+            return conn, conn.getresponse()
+        except BaseException:
+            conn.close()
+            raise
+
+    def send(self, url, headers):
+        redirects = retries = 0
+        while True:
+            parts = urllib.parse.urlsplit(url)
+            path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+            try:
+                conn, res = self.request(parts.scheme, parts.netloc, path, headers)
+            except (http.client.HTTPException, OSError):
+                if retries == self.retries:
+                    raise
+                retry_after = None
+            else:
+                if res.status in self.REDIRECT_STATUS:
+                    res.read()
+                    self.finish(parts.scheme, parts.netloc, conn, res)
+                    if redirects == 10:
+                        raise urllib.error.URLError(f"Too many redirects for {url}")
+                    url = urllib.parse.urljoin(url, res.headers["Location"])
+                    redirects += 1
+                    continue
+                if res.status not in self.RETRY_STATUS or retries == self.retries:
+                    return parts, conn, res
+                retry_after = res.headers.get("Retry-After", "")
+                res.read()
+                self.finish(parts.scheme, parts.netloc, conn, res)
+            self.backoff(retries, retry_after)
+            retries += 1
+
+    def send_proxied(self, url, headers):
+        req = urllib.request.Request(url, headers=headers)
+        retries = 0
+        while True:
+            try:
+                return urllib.request.urlopen(req, timeout=self.timeout)
+            except urllib.error.HTTPError as e:
+                # urllib reports "304 Not Modified" as an error
+                if e.code == 304:
+                    return e
+                if e.code not in self.RETRY_STATUS or retries == self.retries:
+                    raise
+                retry_after = e.headers.get("Retry-After", "")
+                e.close()
+            except (http.client.HTTPException, OSError):
+                if retries == self.retries:
+                    raise
+                retry_after = None
+            self.backoff(retries, retry_after)
+            retries += 1
+
+    def backoff(self, retries, retry_after):
+        if retry_after and retry_after.isdigit():
+            time.sleep(int(retry_after))
+        else:
+            time.sleep(self.backoff_factor * 2**retries)
+
+    @contextlib.contextmanager
+    def urlopen(self, url, headers=None):
+        with self.slots:
+            with self.open(url, headers or {}) as res:
+                yield res
+
+    @contextlib.contextmanager
+    def open(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        proxies = urllib.request.getproxies()
+        if parts.scheme in proxies and not urllib.request.proxy_bypass(parts.hostname):
+            # let urllib deal with proxies
+            with self.send_proxied(url, headers) as res:
+                yield res
+            return
+
+        parts, conn, res = self.send(url, headers)
+        try:
+            if res.status >= 400:
+                res.read()
+                raise urllib.error.HTTPError(
+                    url, res.status, res.reason, res.headers, None
+                )
+            yield res
+        except BaseException:
+            conn.close()
+            raise
+        else:
+            self.finish(parts.scheme, parts.netloc, conn, res)
+
+
+class Progress:
+    """Prints the progress of downloads running on several threads on one
+    status line, refreshed at most every interval seconds."""
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.last = 0
+        self.width = 0
+        self.lock = threading.Lock()
+
+    def show(self, line, end=""):
+        self.width = max(self.width, len(line))
+        print(f"\r{line:{self.width}}", end=end, flush=True)
+
+    def update(self, name, perc):
+        now = time.monotonic()
+        if now - self.last < self.interval:
+            return
+        with self.lock:
+            self.last = now
+            self.show(f"{name} ... {perc}%")
+
+    def done(self, name):
+        with self.lock:
+            self.show(f"{name} ... 100%", end="\n")
+
+    def message(self, text):
+        with self.lock:
+            self.show(text, end="\n")
+
 
 def main():
     # other architectures may work or may not - not really tested
@@ -20,39 +236,275 @@ def main():
 
     MANIFEST_URL = "https://aka.ms/vs/17/release/channel"
 
+    CACHE = (
+        Path(
+            os.environ.get("XDG_CACHE_HOME")
+            or os.environ.get("LOCALAPPDATA")
+            or Path.home() / ".cache"
+        )
+        / "msvc-installer"
+    )
+
+    # concurrent downloads of each of the MSVC and SDK installs
+    DOWNLOAD_WORKERS = 8
+
+    # payloads at least this large are downloaded as several ranges at once
+    PARALLEL_DOWNLOAD_SIZE = 64 << 20
+
+    # one connection per download worker, the two installs run side by side
+    pool = ConnectionPool(maxsize=2 * DOWNLOAD_WORKERS)
+
+    progress = Progress()
+
+    # set on the first failure, so that the downloads, extractions and msiexec
+    # runs still in progress give up rather than finish for nothing
+    stopping = threading.Event()
+    # what caused it, reported instead of the CancelledError of the work it
+    # stopped, whichever of them reaches the main thread first
+    failures = []
+
+    def check_stopping():
+        if stopping.is_set():
+            raise CancelledError()
+
+    # wraps the work done on executor, cancels whatever is still queued when
+    # the block fails instead of waiting for all of it on the way out
+    @contextlib.contextmanager
+    def stop_on_error(executor):
+        try:
+            yield executor
+        except BaseException as e:
+            if not isinstance(e, CancelledError):
+                failures.append(e)
+            stopping.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            if isinstance(e, CancelledError) and failures:
+                raise failures[0]
+            raise
+
     def download(url):
-        with urllib.request.urlopen(url) as res:
+        with pool.urlopen(url) as res:
             return res.read()
 
-    def download_progress(url, check, name, f):
-        data = io.BytesIO()
-        with urllib.request.urlopen(url) as res:
-            total = int(res.headers["Content-Length"])
-            size = 0
-            while True:
-                block = res.read(1 << 20)
-                if not block:
+    def write_atomic(path, data):
+        # a unique name, several runs may share the cache
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, prefix=path.name, suffix=".tmp", delete=False
+        ) as tmp:
+            tmp.write(data)
+        try:
+            os.replace(tmp.name, path)
+        except OSError:
+            os.unlink(tmp.name)
+            raise
+
+    # keeps manifests on disk and revalidates them with their ETag or
+    # Last-Modified date, so unchanged manifests are not transferred again
+    def cached_download(url):
+        path = CACHE / hashlib.sha256(url.encode()).hexdigest()
+        meta = path.with_suffix(".meta")
+        headers = {}
+        if path.exists() and meta.exists():
+            try:
+                validators = json_loads(meta.read_bytes())
+            except ValueError:
+                validators = {}
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+        with pool.urlopen(url, headers) as res:
+            if res.status == 304:
+                return path.read_bytes()
+            data = res.read()
+        validators = {
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified"),
+        }
+        try:
+            CACHE.mkdir(parents=True, exist_ok=True)
+            # drop the validators first, a body left without them is simply
+            # downloaded again; both files are swapped in whole with os.replace
+            meta.unlink(missing_ok=True)
+            write_atomic(path, data)
+            if any(validators.values()):
+                write_atomic(meta, json.dumps(validators).encode())
+        except OSError:
+            pass  # caching is best effort
+        return data
+
+    def file_sha256(f):
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        h = hashlib.sha256()
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+        return h.hexdigest()
+
+    # keeps payloads named by their sha256, returns the number of bytes
+    # downloaded and the path of the verified payload in the cache
+    def cached_payload(url, check, name):
+        path = payload_cache / check.lower()
+        # hashing is cheap next to a download, and the cache may be shared
+        # or left truncated by a crash, so hits are verified all the same
+        if path.exists():
+            with open(path, "rb") as f:
+                if file_sha256(f) == check.lower():
+                    progress.message(f"{name} ... cached")
+                    return 0, path
+        payload_cache.mkdir(parents=True, exist_ok=True)
+        part = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.part")
+        try:
+            with open(part, "w+b") as f:
+                size = download_progress(url, check, name, f)
+            os.replace(part, path)
+        finally:
+            part.unlink(missing_ok=True)
+        return size, path
+
+    def cached_json(url):
+        if args.no_cache:
+            return json_loads(download(url))
+        return json_loads(cached_download(url))
+
+    # size a file upfront so the filesystem can allocate it in one go
+    def preallocate(fd, size):
+        try:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+        except OSError as e:
+            # only a filesystem without support for it is ignored, a full
+            # disk is reported before any data is written
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                raise
+
+    # fetches a large payload as several concurrent ranges, each written at
+    # its own offset in f; a single stream is often capped by the server
+    def download_parts(url, name, f, total, parts=4):
+        lock = threading.Lock()
+        done = 0
+
+        def fetch_part(start, end, retries=5):
+            nonlocal done
+            buf = bytearray(1 << 20)
+            view = memoryview(buf)
+            while start < end:
+                headers = {"Range": f"bytes={start}-{end - 1}"}
+                error = None
+                with pool.urlopen(url, headers) as res:
+                    if res.status != 206:
+                        raise http.client.HTTPException(f"No range for {url}")
+                    while start < end:
+                        try:
+                            n = res.readinto(view[: end - start])
+                        except (http.client.HTTPException, OSError) as e:
+                            error, n = e, 0
+                        if not n:
+                            break
+                        with lock:
+                            f.seek(start)
+                            f.write(view[:n])
+                            done += n
+                        start += n
+                        progress.update(name, done * 100 // total)
+                        check_stopping()
+                if start < end:
+                    # cut off midway, resume where it stopped
+                    if not retries:
+                        raise http.client.IncompleteRead(b"", end - start) from error
+                    retries -= 1
+
+        bounds = [total * i // parts for i in range(parts + 1)]
+        with ThreadPoolExecutor(max_workers=parts) as executor:
+            with stop_on_error(executor):
+                futures = [
+                    executor.submit(fetch_part, start, end)
+                    for start, end in zip(bounds[:-1], bounds[1:])
+                ]
+                # the first part to fail stops the others right away
+                for future in as_completed(futures):
+                    future.result()
+        f.flush()
+
+    def download_progress(url, check, name, f, retries=5):
+        # hash while downloading rather than re-reading the file afterwards;
+        # hashlib uses OpenSSL's sha256 (SHA-NI accelerated on CPUs that have
+        # it) and releases the GIL on 1 MiB blocks, so workers hash in parallel
+        h = hashlib.sha256()
+        size = 0
+        # one buffer per download, filled in place rather than a new bytes
+        # object for every block
+        buf = bytearray(1 << 20)
+        view = memoryview(buf)
+        while True:
+            # after an interruption, ask only for the bytes still missing
+            headers = {"Range": f"bytes={size}-"} if size else {}
+            error = None
+            with pool.urlopen(url, headers) as res:
+                if size and res.status != 206:
+                    # range not honored, start over
+                    f.seek(0)
+                    f.truncate()
+                    h = hashlib.sha256()
+                    size = 0
+                total = size + int(res.headers["Content-Length"])
+                if not size and total:
+                    # also makes a full disk fail now rather than midway
+                    f.flush()
+                    preallocate(f.fileno(), total)
+                if (
+                    not size
+                    and total >= PARALLEL_DOWNLOAD_SIZE
+                    and res.headers.get("Accept-Ranges") == "bytes"
+                ):
+                    # drop this response, the body is fetched in parts
                     break
-                f.write(block)
-                data.write(block)
-                size += len(block)
-                perc = size * 100 // total
-                print(f"\r{name} ... {perc}%", end="")
-        print()
-        data = data.getvalue()
-        digest = hashlib.sha256(data).hexdigest()
+                while size < total:
+                    # only network errors end up here, failing to write to f
+                    # is not something another request would fix
+                    try:
+                        n = res.readinto(buf)
+                    except (http.client.HTTPException, OSError) as e:
+                        error, n = e, 0
+                    if not n:
+                        break
+                    f.write(view[:n])
+                    h.update(view[:n])
+                    size += n
+                    perc = size * 100 // total
+                    progress.update(name, perc)
+                    check_stopping()
+            if size == total:
+                break
+            # cut off midway, the pool already retried the request itself so
+            # only the transfer is resumed here
+            if not retries:
+                raise http.client.IncompleteRead(b"", total - size) from error
+            retries -= 1
+        if size < total:
+            download_parts(url, name, f, total)
+            # parts arrive out of order, so they are hashed afterwards, which
+            # is why callers open f for reading as well
+            f.seek(0)
+            digest = file_sha256(f)
+            size = total
+        else:
+            digest = h.hexdigest()
+        progress.done(name)
         if check.lower() != digest:
-            exit(f"Hash mismatch for f{pkg}")
-        return data
+            exit(f"Hash mismatch for {name}")
+        return size
 
     # super crappy msi format parser just to find required .cab files
     def get_msi_cabs(msi):
-        index = 0
-        while True:
-            index = msi.find(b".cab", index + 4)
-            if index < 0:
-                return
-            yield msi[index - 32 : index + 4].decode("ascii")
+        seen = set()
+        for m in CAB_RE.finditer(msi):
+            name = m.group(0).decode("ascii")
+            if name not in seen:
+                seen.add(name)
+                yield name
 
     def first(items, cond):
         return next(item for item in items if cond(item))
@@ -72,6 +524,12 @@ def main():
         action="store_const",
         help="Automatically accept license",
     )
+    ap.add_argument(
+        "--no-cache",
+        const=True,
+        action="store_const",
+        help="Neither use nor update the on-disk manifest and payload caches",
+    )
     ap.add_argument("--msvc-version", help="Get specific MSVC version")
     ap.add_argument("--sdk-version", help="Get specific Windows SDK version")
     ap.add_argument("--components", action="extend", nargs="+", type=str)
@@ -79,17 +537,17 @@ def main():
         "--discard", nargs="*", help="Extra arguments which will be discarded"
     )
     args = ap.parse_args()
-
-    OUTPUT = Path(os.environ["LIBRARY_PREFIX"]) / "vs_buildtools"  # output folder
+    if not args.show_versions and not args.components:
+        ap.error("--components is required unless --show-versions is given")
 
     # get and validate components
-    components = set(args.components)
+    components = set(args.components or ())
     available_components = {"msvc", "asan", "sdk", "crt"}
     if not components.issubset(available_components):
         raise ValueError(f"Invalid components {components - available_components}")
 
     ### get main manifest
-    manifest = json.loads(download(MANIFEST_URL))
+    manifest = cached_json(MANIFEST_URL)
 
     ### download VS manifest
     vs = first(
@@ -98,26 +556,23 @@ def main():
     )
     payload = vs["payloads"][0]["url"]
 
-    vsmanifest = json.loads(download(payload))
+    vsmanifest = cached_json(payload)
 
     ### find MSVC & WinSDK versions
-    packages = {}
+    packages = defaultdict(list)
     for p in vsmanifest["packages"]:
-        packages.setdefault(p["id"].lower(), []).append(p)
+        packages[p["id"].lower()].append(p)
+    packages = dict(packages)  # unknown ids must still raise KeyError
 
     msvc = {}
     sdk = {}
 
     for pid, p in packages.items():
-        if pid.startswith(
-            "Microsoft.VisualStudio.Component.VC.".lower()
-        ) and pid.endswith(".x86.x64".lower()):
+        if pid.startswith(VC_PREFIX) and pid.endswith(VC_SUFFIX):
             pver = ".".join(pid.split(".")[4:6])
             if pver[0].isnumeric():
                 msvc[pver] = pid
-        elif pid.startswith(
-            "Microsoft.VisualStudio.Component.Windows10SDK.".lower()
-        ) or pid.startswith("Microsoft.VisualStudio.Component.Windows11SDK.".lower()):
+        elif pid.startswith(SDK_PREFIXES):
             pver = pid.split(".")[-1]
             if pver.isnumeric():
                 sdk[pver] = pid
@@ -127,6 +582,13 @@ def main():
         print("Windows SDK versions:", " ".join(sorted(sdk.keys())))
         exit(0)
 
+    OUTPUT = Path(os.environ["LIBRARY_PREFIX"]) / "vs_buildtools"  # output folder
+
+    # payloads add up to several GB, they are only kept when asked to
+    payload_cache = None
+    if os.environ.get("MSVC_INSTALLER_CACHE") and not args.no_cache:
+        payload_cache = Path(os.environ["MSVC_INSTALLER_CACHE"])
+
     msvc_ver = args.msvc_version or max(sorted(msvc.keys()))
     sdk_ver = args.sdk_version or max(sorted(sdk.keys()))
 
@@ -158,9 +620,7 @@ def main():
             exit(0)
 
     OUTPUT.mkdir(exist_ok=True, parents=True)
-    total_download = 0
 
-    msvcv = None
     sdkv = None
 
     ### download MSVC
@@ -190,26 +650,90 @@ def main():
     selected_msvc_components = [
         c for component in components for c in msvc_packages.get(component, [])
     ]
-    for pkg in selected_msvc_components:
-        p = first(packages[pkg], lambda p: p.get("language") in (None, "en-US"))
-        for payload in p["payloads"]:
-            with tempfile.TemporaryFile() as f:
-                data = download_progress(payload["url"], payload["sha256"], pkg, f)
-                total_download += len(data)
-                with zipfile.ZipFile(f) as z:
-                    for name in z.namelist():
-                        if name.startswith("Contents/"):
-                            out = OUTPUT / Path(name).relative_to("Contents")
-                            out.parent.mkdir(parents=True, exist_ok=True)
-                            out.write_bytes(z.read(name))
-
-    msvc_install_dir = list((OUTPUT / "VC/Tools/MSVC").glob("*"))
-    if msvc_install_dir:
-        msvcv = msvc_install_dir[0].name
+
+    def extract(z, info, out):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+        fd = os.open(out, flags, 0o644)
+        try:
+            if info.file_size:
+                preallocate(fd, info.file_size)
+            with z.open(info) as src:
+                while True:
+                    block = src.read(1 << 20)
+                    if not block:
+                        break
+                    check_stopping()
+                    view = memoryview(block)
+                    while view:
+                        view = view[os.write(fd, view) :]
+        finally:
+            os.close(fd)
+
+    def fetch_and_extract(pkg, payload):
+        # payloads are fetched whole rather than member by member with range
+        # requests: the manifest sha256 covers the entire archive, and all but
+        # a few small metadata files live under Contents/ anyway
+        with contextlib.ExitStack() as stack:
+            if payload_cache:
+                size, path = cached_payload(payload["url"], payload["sha256"], pkg)
+                f = stack.enter_context(open(path, "rb"))
+            else:
+                f = stack.enter_context(tempfile.TemporaryFile())
+                size = download_progress(payload["url"], payload["sha256"], pkg, f)
+                f.flush()
+            # read the archive through a mapping, member reads and the
+            # central directory lookup become memory copies, not syscalls
+            mm = MappedFile(f.fileno(), 0, access=mmap.ACCESS_READ)
+            stack.enter_context(mm)
+            z = stack.enter_context(zipfile.ZipFile(mm))
+            members = [
+                (info, OUTPUT.joinpath(info.filename[len("Contents/") :]))
+                for info in z.infolist()
+                if info.filename.startswith("Contents/")
+            ]
+            # create directories once upfront rather than once per file,
+            # skipping those already created for a previous payload
+            parents = {out.parent for _, out in members} - created_dirs
+            for parent in sorted(parents, key=lambda p: len(p.parts)):
+                parent.mkdir(parents=True, exist_ok=True)
+            created_dirs.update(parents)
+            # ZipFile serializes reads of the archive itself, inflating and
+            # writing members happens in parallel (zlib drops the GIL); this
+            # download worker moves on to the next payload meanwhile, the
+            # archive is closed once all of its members are written
+            jobs = [extractor.submit(extract, z, *member) for member in members]
+            return size, jobs, stack.pop_all()
+
+    extractor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+    created_dirs = {OUTPUT}
+
+    def install_vc_components():
+        total = 0
+        # payloads are independent, so fetch them concurrently
+        tasks = []
+        for pkg in selected_msvc_components:
+            p = first(packages[pkg], lambda p: p.get("language") in (None, "en-US"))
+            tasks += [(pkg, payload) for payload in p["payloads"]]
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor, extractor:
+            with stop_on_error(executor), stop_on_error(extractor):
+                futures = [executor.submit(fetch_and_extract, *task) for task in tasks]
+                for future in as_completed(futures):
+                    size, jobs, archive = future.result()
+                    total += size
+                    # the other payloads keep downloading meanwhile; each
+                    # archive is closed once extracted, so only those still
+                    # waiting for extraction take up temporary disk space
+                    with archive:
+                        for job in jobs:
+                            job.result()
+
+        msvc_install_dir = list((OUTPUT / "VC/Tools/MSVC").glob("*"))
+        return total, msvc_install_dir[0].name if msvc_install_dir else None
 
     ### download Windows SDK
 
-    if "sdk" in components:
+    def install_sdk():
+        total = 0
         sdk_packages = [
             # Windows SDK tools (like rc.exe & mt.exe)
             f"Windows SDK for Windows Store Apps Tools-x86_en-us.msi",
@@ -233,44 +757,93 @@ def main():
                 0
             ]
 
-            msi = []
-            cabs = []
-
-            # download msi files
-            for pkg in sdk_packages:
-                payload = first(
-                    sdk_pkg["payloads"], lambda p: p["fileName"] == f"Installers\\{pkg}"
-                )
-                msi.append(dst / pkg)
-                with open(dst / pkg, "wb") as f:
-                    data = download_progress(payload["url"], payload["sha256"], pkg, f)
-                total_download += len(data)
-                cabs += list(get_msi_cabs(data))
-
-            # download .cab files
-            for pkg in cabs:
-                payload = first(
-                    sdk_pkg["payloads"], lambda p: p["fileName"] == f"Installers\\{pkg}"
-                )
-                with open(dst / pkg, "wb") as f:
-                    download_progress(payload["url"], payload["sha256"], pkg, f)
-
-            print("Unpacking msi files...")
+            sdk_payloads = {p["fileName"]: p for p in sdk_pkg["payloads"]}
+
+            def fetch(pkg):
+                payload = sdk_payloads[f"Installers\\{pkg}"]
+                if payload_cache:
+                    size, path = cached_payload(payload["url"], payload["sha256"], pkg)
+                    try:
+                        os.link(path, dst / pkg)
+                    except OSError:
+                        shutil.copyfile(path, dst / pkg)
+                    return size
+                with open(dst / pkg, "w+b") as f:
+                    return download_progress(payload["url"], payload["sha256"], pkg, f)
+
+            def fetch_msi(pkg):
+                size = fetch(pkg)
+                # scan the file mapped in place instead of reading it into memory
+                with open(dst / pkg, "rb") as f:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        return size, list(get_msi_cabs(mm))
+
+            msi = [dst / pkg for pkg in sdk_packages]
+            cabs = set()
+
+            # download msi files, and start on their .cab files as soon as
+            # each msi is in, while the other msi files are still in flight
+            with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+                with stop_on_error(executor):
+                    msi_futures = [
+                        executor.submit(fetch_msi, pkg) for pkg in sdk_packages
+                    ]
+                    cab_futures = []
+                    for future in as_completed(msi_futures):
+                        size, msi_cabs = future.result()
+                        total += size
+                        for pkg in msi_cabs:
+                            if pkg not in cabs:
+                                cabs.add(pkg)
+                                cab_futures.append(executor.submit(fetch, pkg))
+                    for future in as_completed(cab_futures):
+                        future.result()
+
+            progress.message("Unpacking msi files...")
 
             # run msi installers
-            for m in msi:
-                subprocess.check_call(
-                    [
-                        "msiexec.exe",
-                        "/a",
-                        m,
-                        "/quiet",
-                        "/qn",
-                        f"TARGETDIR={OUTPUT.resolve()}",
-                    ]
-                )
+            def msiexec(m):
+                return [
+                    "msiexec.exe",
+                    "/a",
+                    m,
+                    "/quiet",
+                    "/qn",
+                    f"TARGETDIR={OUTPUT.resolve()}",
+                ]
+
+            def run_msiexec(m):
+                check_stopping()
+                return subprocess.call(msiexec(m))
+
+            workers = min(len(msi), 6, os.cpu_count() or 1)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                with stop_on_error(executor):
+                    codes = list(executor.map(run_msiexec, msi))
+
+            for m, code in zip(msi, codes):
+                # ERROR_INSTALL_ALREADY_RUNNING: Windows Installer would not
+                # run this one next to another msiexec, redo it on its own
+                if code == 1618:
+                    code = subprocess.call(msiexec(m))
+                if code:
+                    raise subprocess.CalledProcessError(code, msiexec(m))
 
             sdkv = list((OUTPUT / "Windows Kits/10/bin").glob("*"))[0].name
+        return total, sdkv
+
+    # MSVC and SDK downloads are independent, run them side by side
+    with ThreadPoolExecutor(max_workers=2) as executor, stop_on_error(executor):
+        installs = [executor.submit(install_vc_components)]
+        if "sdk" in components:
+            installs.append(executor.submit(install_sdk))
+        # whichever fails first stops the other one
+        for future in as_completed(installs):
+            future.result()
+        total_download, msvcv = installs[0].result()
+        if "sdk" in components:
+            size, sdkv = installs[1].result()
+            total_download += size
 
     ### versions
 
@@ -318,39 +891,36 @@ def main():
     #     src.replace(dst / "msdia140.dll")
 
     ### cleanup
-    shutil.rmtree(OUTPUT / "Common7", ignore_errors=True)
+    unused = [OUTPUT / "Common7"]
+    other_arches = [arch for arch in ARCHES if arch != TARGET]
     if msvcv:
+        msvc_base = OUTPUT / "VC/Tools/MSVC" / msvcv
         for f in ["Auxiliary", f"lib/{TARGET}/store", f"lib/{TARGET}/uwp"]:
-            shutil.rmtree(OUTPUT / "VC/Tools/MSVC" / msvcv / f, ignore_errors=True)
-    for f in OUTPUT.glob("*.msi"):
-        f.unlink()
+            unused.append(msvc_base / f)
+        for arch in other_arches:
+            unused.append(msvc_base / f"bin/Host{arch}")
     if sdkv:
+        sdk_base = OUTPUT / "Windows Kits/10"
         for f in [
             "Catalogs",
             "DesignTime",
             f"bin/{sdkv}/chpe",
             f"Lib/{sdkv}/ucrt_enclave",
         ]:
-            shutil.rmtree(OUTPUT / "Windows Kits/10" / f, ignore_errors=True)
-    for arch in ["x86", "x64", "arm", "arm64"]:
-        if arch != TARGET:
-            if msvcv:
-                shutil.rmtree(
-                    OUTPUT / "VC/Tools/MSVC" / msvcv / f"bin/Host{arch}",
-                    ignore_errors=True,
-                )
-            if sdkv:
-                shutil.rmtree(
-                    OUTPUT / "Windows Kits/10/bin" / sdkv / arch, ignore_errors=True
-                )
-                shutil.rmtree(
-                    OUTPUT / "Windows Kits/10/Lib" / sdkv / "ucrt" / arch,
-                    ignore_errors=True,
-                )
-                shutil.rmtree(
-                    OUTPUT / "Windows Kits/10/Lib" / sdkv / "um" / arch,
-                    ignore_errors=True,
-                )
+            unused.append(sdk_base / f)
+        for arch in other_arches:
+            unused.append(sdk_base / "bin" / sdkv / arch)
+            unused.append(sdk_base / "Lib" / sdkv / "ucrt" / arch)
+            unused.append(sdk_base / "Lib" / sdkv / "um" / arch)
+
+    # the trees are disjoint, so they can be deleted concurrently
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda p: shutil.rmtree(p, ignore_errors=True), unused))
+    # msiexec /a leaves a copy of each msi in TARGETDIR
+    with os.scandir(OUTPUT) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith(".msi") and entry.is_file():
+                os.unlink(entry.path)
 
     class Environment:
         # Read in conda build environment variables
@@ -386,17 +956,14 @@ def main():
     class AtTemplate(string.Template):
         delimiter = "@"
 
-    def subs(line, args):
-        t = AtTemplate(line)
-        d = {
-            "PREFIX": OUTPUT,
-            "MSVC_VERSION": msvcv,
-            "HOST_ARCH": HOST,
-            "TARGET_ARCH": TARGET,
-            "SDK_VERSION": sdkv,
-            "SDK_TARGET_ARCH": TARGET,
-        }
-        return t.substitute(d)
+    substitutes = {
+        "PREFIX": OUTPUT,
+        "MSVC_VERSION": msvcv,
+        "HOST_ARCH": HOST,
+        "TARGET_ARCH": TARGET,
+        "SDK_VERSION": sdkv,
+        "SDK_TARGET_ARCH": TARGET,
+    }
 
     env = Environment()
     activation_hooks_dir = Path(env.prefix) / "etc" / "conda" / "activate.d"
@@ -404,30 +971,33 @@ def main():
     os.makedirs(activation_hooks_dir, exist_ok=True)
     os.makedirs(deactivation_hooks_dir, exist_ok=True)
 
-    def copy_and_rename(source, target):
-        with open(source, "r") as r:
-            with open(target, "w") as w:
-                for line in r:
-                    w.write(subs(line, args))
+    def copy_and_rename(source, target, substitutes):
+        # substitute the whole file at once instead of line by line
+        text = Path(source).read_text()
+        Path(target).write_text(AtTemplate(text).substitute(substitutes))
 
     if "msvc" in components:
         copy_and_rename(
             env.recipe_dir / "activate_msvc.bat",
             activation_hooks_dir / "vs_buildtools-msvc.bat",
+            substitutes,
         )
         copy_and_rename(
             env.recipe_dir / "deactivate_msvc.bat",
             deactivation_hooks_dir / "vs_buildtools-msvc.bat",
+            substitutes,
         )
 
     if "sdk" in components:
         copy_and_rename(
             env.recipe_dir / "activate_sdk.bat",
             activation_hooks_dir / "vs_buildtools-sdk.bat",
+            substitutes,
         )
         copy_and_rename(
             env.recipe_dir / "deactivate_sdk.bat",
             deactivation_hooks_dir / "vs_buildtools-sdk.bat",
+            substitutes,
         )
 
     print(f"Total downloaded: {total_download>>20} MB")